@@ -2,6 +2,11 @@
 pyramid application.
 """
 from pyramid.config import Configurator
+from pyramid.events import BeforeRender
+from pyramid.settings import asbool
+
+from calibrationreport import profiling
+from calibrationreport.bundle import add_renderer_globals, load_manifest
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application. Check the
@@ -9,9 +14,23 @@ def main(global_config, **settings):
     """
     config = Configurator(settings=settings)
     config.include("pyramid_chameleon")
+
+    profiling.apply_magick_limits(settings)
+    if asbool(settings.get("calibrationreport.profile_memory", False)):
+        profiling.enable()
+        config.add_tween("calibrationreport.profiling.memory_tween_factory")
+
+    # Fingerprinted bundles from the calibrationreport_bundle build step
+    # are served before the plain static view, see bundle.py
+    config.registry.asset_manifest = load_manifest()
+    config.add_subscriber(add_renderer_globals, BeforeRender)
+    config.add_route("bundle", "/assets/dist/{filename}")
+
     config.add_static_view("assets", "assets", cache_max_age=3600)
     config.add_route("calibration_report", "/")
     config.add_route("view_pdf", "/view_pdf/{serial}")
     config.add_route("view_thumbnail", "/view_thumbnail/{serial}")
+    config.add_route("gallery", "/gallery/{page}")
+    config.add_route("gallery_sprite", "/gallery_sprite/{page}")
     config.scan()
     return config.make_wsgi_app()
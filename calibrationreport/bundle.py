@@ -0,0 +1,190 @@
+""" Bundle - build step that concatenates the static assets used by the
+form page, fingerprints the bundles with a content hash and writes gzip
+and brotli precompressed copies next to them. Run it after every asset
+change:
+
+    $VENV/bin/calibrationreport_bundle
+"""
+
+import os
+import re
+import sys
+import gzip
+import time
+import json
+import hashlib
+import logging
+
+try:
+    import brotli
+except ImportError: # pragma: no cover
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+ASSETS_DIR = "%s/assets" % os.path.dirname(__file__)
+
+# Bundles written to assets/dist, in the order the form template loads
+# them. dist is one level below assets, like css/ and js/, so relative
+# urls inside the stylesheets keep working.
+BUNDLES = {
+    "app.css": ["css/bootstrap.min.css", "css/form.css"],
+    "app.js": ["js/bootstrap.min.js", "js/deform.js"],
+    }
+
+CONTENT_TYPES = {
+    ".css": "text/css",
+    ".js": "application/javascript",
+    }
+
+# Precompressed suffixes in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# Seconds the bundles of a replaced build are kept, so pages cached with
+# the old fingerprinted urls, and servers still running with the old
+# manifest, keep loading them through a deploy
+BUNDLE_RETENTION = 30 * 24 * 3600
+
+def minify_css(text):
+    """ Strip comments and collapse whitespace. Only used on the small
+    hand written stylesheets, the bootstrap bundle is already minified.
+    """
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,])\s*", r"\1", text)
+    return text.strip()
+
+def build_bundle(name, dist_dir):
+    """ Concatenate the sources of the named bundle, write it with a
+    content hash in the filename and its precompressed variants. Return
+    the fingerprinted filename.
+    """
+    base_name, extension = os.path.splitext(name)
+    parts = []
+    for source in BUNDLES[name]:
+        with open("%s/%s" % (ASSETS_DIR, source), "rb") as in_file:
+            data = in_file.read()
+        if extension == ".css" and ".min." not in source:
+            data = minify_css(data.decode("utf-8")).encode("utf-8")
+        parts.append(data)
+
+    # Separate scripts with a semicolon so a file without a trailing
+    # one can not run into the next
+    separator = b"\n;\n" if extension == ".js" else b"\n"
+    content = separator.join(parts)
+
+    digest = hashlib.md5(content).hexdigest()[:12]
+    filename = "%s.%s%s" % (base_name, digest, extension)
+    out_name = "%s/%s" % (dist_dir, filename)
+    with open(out_name, "wb") as out_file:
+        out_file.write(content)
+
+    # mtime=0 keeps the gzip output identical between builds
+    with open(out_name + ".gz", "wb") as raw_file:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=raw_file,
+                           compresslevel=9, mtime=0) as gz_file:
+            gz_file.write(content)
+
+    if brotli is not None:
+        with open(out_name + ".br", "wb") as out_file:
+            out_file.write(brotli.compress(content))
+    else:
+        log.warn("brotli is not installed, skipping %s.br", filename)
+
+    log.info("Bundled %s: %s bytes", filename, len(content))
+    return filename
+
+def build(dist_dir=None, retention=BUNDLE_RETENTION):
+    """ Write every bundle and the manifest mapping bundle names to
+    fingerprinted filenames. Return the manifest. The bundles of earlier
+    builds are removed once they have been out of the manifest for
+    retention seconds.
+    """
+    if dist_dir is None:
+        dist_dir = "%s/dist" % ASSETS_DIR
+
+    if not os.path.exists(dist_dir):
+        os.makedirs(dist_dir)
+
+    previous = load_manifest(dist_dir)
+
+    manifest = {}
+    for name in sorted(BUNDLES):
+        manifest[name] = build_bundle(name, dist_dir)
+
+    # The replaced bundles start aging from now, not from the time they
+    # were built
+    for filename in set(previous.values()) - set(manifest.values()):
+        for suffix in [""] + [suffix for name, suffix in ENCODINGS]:
+            full_name = "%s/%s%s" % (dist_dir, filename, suffix)
+            if os.path.exists(full_name):
+                os.utime(full_name, None)
+
+    with open("%s/manifest.json" % dist_dir, "w") as out_file:
+        json.dump(manifest, out_file, indent=4, sort_keys=True)
+
+    prune_bundles(dist_dir, manifest, retention)
+    return manifest
+
+def prune_bundles(dist_dir, manifest, retention=BUNDLE_RETENTION):
+    """ Remove the bundles and precompressed variants that are not in
+    the manifest and have not been modified for retention seconds.
+    """
+    current = set(manifest.values())
+    oldest = time.time() - retention
+    for filename in os.listdir(dist_dir):
+        bundle_name = filename
+        for name, suffix in ENCODINGS:
+            if filename.endswith(suffix):
+                bundle_name = filename[:-len(suffix)]
+
+        full_name = "%s/%s" % (dist_dir, filename)
+        if filename == "manifest.json" or bundle_name in current:
+            continue
+
+        if os.path.getmtime(full_name) < oldest:
+            log.info("Remove expired bundle %s", filename)
+            os.remove(full_name)
+
+def load_manifest(dist_dir=None):
+    """ Return the manifest of the last build, an empty dictionary if
+    the assets have not been bundled.
+    """
+    if dist_dir is None:
+        dist_dir = "%s/dist" % ASSETS_DIR
+
+    filename = "%s/manifest.json" % dist_dir
+    if not os.path.exists(filename):
+        return {}
+
+    with open(filename) as in_file:
+        return json.load(in_file)
+
+def asset_urls(request, name):
+    """ Return the list of urls the page should load for the named
+    bundle. This is the fingerprinted bundle when it has been built,
+    the individual source files otherwise.
+    """
+    manifest = getattr(request.registry, "asset_manifest", {})
+    if name in manifest:
+        return [request.route_path("bundle", filename=manifest[name])]
+
+    return [request.static_path("calibrationreport:assets/%s" % source)
+            for source in BUNDLES[name]]
+
+def add_renderer_globals(event):
+    """ BeforeRender subscriber to make asset_urls available to the
+    templates.
+    """
+    request = event.get("request")
+    if request is not None:
+        event["asset_urls"] = lambda name: asset_urls(request, name)
+
+def main(argv=sys.argv):
+    """ Console script entry point, build the bundles in the package
+    assets directory.
+    """
+    logging.basicConfig(level=logging.INFO)
+    manifest = build()
+    for name in sorted(manifest):
+        print("%s -> %s" % (name, manifest[name]))
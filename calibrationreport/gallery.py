@@ -0,0 +1,158 @@
+""" Gallery - compose the cached small thumbnails of the latest reports
+into paged contact sheet sprites with a coordinate map, so a dashboard
+can show hundreds of reports in a couple of requests.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+from wand.color import Color
+from wand.image import Image as WandImage
+
+from calibrationreport.pdfgenerator import thumbnail_filename
+from calibrationreport.pdfgenerator import write_thumbnails
+
+log = logging.getLogger(__name__)
+
+GALLERY_PAGE_SIZE = 100
+GALLERY_COLUMNS = 10
+TILE_WIDTH = 124
+TILE_HEIGHT = 175
+
+# Slugified serial numbers never contain an underscore, so the sprite
+# cache can not collide with a report directory.
+GALLERY_DIR = "_gallery"
+
+def list_reports(reports_dir="reports"):
+    """ Return a list of (serial, mtime) for every report directory that
+    has a pdf, newest report first.
+    """
+    reports = []
+    for serial in os.listdir(reports_dir):
+        pdf_filename = "%s/%s/report.pdf" % (reports_dir, serial)
+        if serial.startswith("_") or not os.path.exists(pdf_filename):
+            continue
+        reports.append((serial, os.path.getmtime(pdf_filename)))
+
+    reports.sort(key=lambda item: (-item[1], item[0]))
+    return reports
+
+def page_count(reports, page_size=GALLERY_PAGE_SIZE):
+    """ Number of sprite pages needed for the list of reports, at least
+    one so an empty gallery still has a first page.
+    """
+    return max(1, (len(reports) + page_size - 1) // page_size)
+
+def sprite_filename(page, reports_dir="reports"):
+    """ Return the cached sprite filename for the page number.
+    """
+    return "%s/%s/page_%s.jpg" % (reports_dir, GALLERY_DIR, page)
+
+def manifest_filename(page, reports_dir="reports"):
+    """ Return the coordinate map filename for the page number.
+    """
+    return "%s/%s/page_%s.json" % (reports_dir, GALLERY_DIR, page)
+
+def gallery_page(page, reports_dir="reports",
+                 page_size=GALLERY_PAGE_SIZE):
+    """ Return the coordinate map of the page, rebuilding its sprite if
+    any report on the page was added or regenerated since the sprite was
+    written. Reports are ordered newest first, so regenerating a report
+    only invalidates the pages up to the one it used to be on. Returns
+    None if the page does not exist.
+    """
+    reports = list_reports(reports_dir)
+    pages = page_count(reports, page_size)
+    if page < 0 or page >= pages:
+        return None
+
+    members = reports[page * page_size:(page + 1) * page_size]
+    tiles = []
+    for index, (serial, mtime) in enumerate(members):
+        tiles.append({"serial": serial, "mtime": mtime,
+                      "x": (index % GALLERY_COLUMNS) * TILE_WIDTH,
+                      "y": (index // GALLERY_COLUMNS) * TILE_HEIGHT})
+
+    manifest = {"page": page, "pages": pages,
+                "tile_width": TILE_WIDTH, "tile_height": TILE_HEIGHT,
+                "tiles": tiles}
+
+    cached = load_manifest(page, reports_dir)
+    sprite = sprite_filename(page, reports_dir)
+    if cached == manifest and (not tiles or os.path.exists(sprite)):
+        return cached
+
+    log.info("Rebuild gallery page %s of %s", page, pages)
+    gallery_dir = "%s/%s" % (reports_dir, GALLERY_DIR)
+    if not os.path.exists(gallery_dir):
+        os.makedirs(gallery_dir)
+
+    if tiles:
+        write_sprite(tiles, sprite, reports_dir)
+    save_manifest(manifest, page, reports_dir)
+    return manifest
+
+def sprite_version(manifest):
+    """ Return a short hash of the serial numbers and modification times
+    of the page tiles. It changes whenever a report on the page is
+    regenerated, or a report joins or leaves the page.
+    """
+    members = [[tile["serial"], tile["mtime"]] for tile in manifest["tiles"]]
+    digest = hashlib.md5(json.dumps(members).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+def load_manifest(page, reports_dir="reports"):
+    """ Return the cached coordinate map of the page, None if there is
+    not one.
+    """
+    filename = manifest_filename(page, reports_dir)
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as in_file:
+        return json.load(in_file)
+
+def save_manifest(manifest, page, reports_dir="reports"):
+    """ Write the coordinate map of the page, via a temporary file so
+    readers never see a partial map.
+    """
+    filename = manifest_filename(page, reports_dir)
+    handle, temp_filename = tempfile.mkstemp(suffix=".json",
+                                    dir=os.path.dirname(filename))
+    with os.fdopen(handle, "w") as out_file:
+        json.dump(manifest, out_file)
+    os.rename(temp_filename, filename)
+
+def write_sprite(tiles, filename, reports_dir="reports"):
+    """ Paste the small thumbnail of each tile at its coordinates and
+    write the contact sheet to disk. Missing small thumbnails are
+    generated from the report pdf.
+    """
+    sprite_dir = os.path.dirname(filename)
+    rows = (len(tiles) + GALLERY_COLUMNS - 1) // GALLERY_COLUMNS
+    columns = min(len(tiles), GALLERY_COLUMNS)
+    with WandImage(width=columns * TILE_WIDTH, height=rows * TILE_HEIGHT,
+                   background=Color("white")) as sprite:
+        for tile in tiles:
+            pdf_filename = "%s/%s/report.pdf" % (reports_dir,
+                                                 tile["serial"])
+            small_filename = thumbnail_filename(pdf_filename, "small",
+                                                "webp")
+            if not os.path.exists(small_filename):
+                write_thumbnails(pdf_filename, [("small", "webp")])
+
+            with WandImage(filename=small_filename) as img:
+                img.resize(TILE_WIDTH, TILE_HEIGHT)
+                sprite.composite(img, left=tile["x"], top=tile["y"])
+
+        sprite.format = "jpeg"
+        sprite.compression_quality = 80
+        handle, temp_filename = tempfile.mkstemp(suffix=".jpg",
+                                                 dir=sprite_dir)
+        os.close(handle)
+        sprite.save(filename=temp_filename)
+
+    os.rename(temp_filename, filename)
@@ -0,0 +1,199 @@
+""" Layouts - declarative page layouts for each product line, compiled
+once per process into draw plans. Positions are in mm from the top left
+of the page, the plans hold them in reportlab points.
+
+Each layout has sections of items, drawn in this order:
+
+    serial, header_footer, product_images, coefficients
+
+An item is one of:
+
+    {"image": resource filename, "x": mm, "y": mm}
+    {"text": static paragraph markup, "x": mm, "y": mm}
+    {"slot": paragraph markup with %(field)s report fields, "x", "y"}
+    {"product": report image filename field, "x", "y", "height": pt}
+
+The product_images section holds product items only, and product items
+are only allowed in it. It is drawn all or nothing: either every product
+image is available and drawn, or none is.
+
+A layout can extend another and replace some of its sections, and
+names the placeholder product images used when nothing is uploaded.
+"""
+
+import os
+import re
+import copy
+import threading
+
+from collections import namedtuple
+
+from reportlab.lib.units import mm
+from reportlab.platypus import Paragraph
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
+
+SECTIONS = ["serial", "header_footer", "product_images", "coefficients"]
+
+LAYOUTS = {
+    "default": {
+        "serial": [
+            {"slot": "<font size=62><i>%(serial)s</i></font>",
+             "x": 20, "y": 65},
+            {"slot": "Calibrated by: Auto-Calibrated on %(timestamp)s",
+             "x": 20, "y": 100},
+            ],
+        "header_footer": [
+            {"image": "resources/calibration_report_header.png",
+             "x": 0, "y": 48},
+            {"image": "resources/calibration_report_footer.png",
+             "x": 0, "y": 280},
+            ],
+        "product_images": [
+            {"product": "top_image_filename", "x": 135, "y": 100,
+             "height": 125},
+            {"product": "bottom_image_filename", "x": 135, "y": 150,
+             "height": 125},
+            ],
+        "coefficients": [
+            {"image": "resources/calibration_text_and_equation.png",
+             "x": 40, "y": 180},
+            {"text": "Where 'p' is pixel index, and:", "x": 60, "y": 190},
+            {"slot": "Coefficient <b>C0 =</b> %(coefficient_0)s",
+             "x": 60, "y": 200},
+            {"slot": "Coefficient <b>C1 =</b> %(coefficient_1)s",
+             "x": 60, "y": 208},
+            {"slot": "Coefficient <b>C2 =</b> %(coefficient_2)s",
+             "x": 60, "y": 216},
+            {"slot": "Coefficient <b>C3 =</b> %(coefficient_3)s",
+             "x": 60, "y": 224},
+            ],
+        "placeholders": {
+            "top_image_filename": "resources/image0_defined.jpg",
+            "bottom_image_filename": "resources/image1_defined.jpg",
+            },
+        },
+
+    "785l": {
+        "extends": "default",
+        "placeholders": {
+            "top_image_filename": "resources/top_image_785l.jpg",
+            "bottom_image_filename": "resources/bottom_image_785l.jpg",
+            },
+        },
+    }
+
+DEFAULT_LAYOUT = "default"
+
+# Image items are relative to the repository, placeholders to the
+# working directory of the application like the rest of reports/
+PACKAGE_DIR = os.path.dirname(__file__)
+
+SLOT_FIELD = re.compile(r"%\((\w+)\)s")
+
+# Built once, every plan shares the same style objects
+STYLES = getSampleStyleSheet()
+
+_compiled = {}
+_compile_lock = threading.Lock()
+
+# Draw operations of a compiled section, positions in points from the
+# bottom left of the page
+ImageOp = namedtuple("ImageOp", ["filename", "x", "y"])
+ProductOp = namedtuple("ProductOp", ["field", "x", "y", "height"])
+TextOp = namedtuple("TextOp", ["para", "x", "y"])
+SlotOp = namedtuple("SlotOp", ["template", "style", "x", "y"])
+
+class DrawPlan(object):
+    """ Compiled layout. Each section is a list of operations with the
+    coordinates already converted to points. Static text is wrapped at
+    compile time and only copied when drawn, so a render does no layout
+    work apart from the variable slots.
+    """
+    def __init__(self, name, sections, placeholders, slot_fields):
+        self.name = name
+        self.sections = sections
+        self.placeholders = placeholders
+        self.slot_fields = slot_fields
+
+def resolve_layout(name):
+    """ Return the layout spec with the sections of any layout it
+    extends filled in.
+    """
+    if name not in LAYOUTS:
+        raise ValueError("Unknown layout: %s" % name)
+
+    spec = dict(LAYOUTS[name])
+    if "extends" in spec:
+        parent = resolve_layout(spec.pop("extends"))
+        parent.update(spec)
+        spec = parent
+    return spec
+
+def to_points(input_x, input_y):
+    """ Convert mm from the top left of the page to reportlab points
+    from the bottom left.
+    """
+    width, height = letter
+    return input_x * mm, height - input_y * mm
+
+def compile_item(item, section, slot_fields):
+    """ Return the draw operation for the layout item. Raises
+    ValueError for a product item outside the product_images section,
+    and for any other item inside it.
+    """
+    pos_x, pos_y = to_points(item["x"], item["y"])
+    if ("product" in item) != (section == "product_images"):
+        raise ValueError("Misplaced layout item: %s" % item)
+
+    if "image" in item:
+        filename = "%s/../%s" % (PACKAGE_DIR, item["image"])
+        return ImageOp(filename, pos_x, pos_y)
+
+    if "product" in item:
+        return ProductOp(item["product"], pos_x, pos_y, item["height"])
+
+    style = STYLES[item.get("style", "Normal")]
+    if "text" in item:
+        para = Paragraph(item["text"], style=style)
+        para.wrap(*letter)
+        return TextOp(para, pos_x, pos_y)
+
+    if "slot" in item:
+        slot_fields.update(SLOT_FIELD.findall(item["slot"]))
+        return SlotOp(item["slot"], style, pos_x, pos_y)
+
+    raise ValueError("Unknown layout item: %s" % item)
+
+def compile_layout(name=None):
+    """ Return the cached DrawPlan for the named layout, compiling it
+    on first use.
+    """
+    if name is None:
+        name = DEFAULT_LAYOUT
+
+    plan = _compiled.get(name)
+    if plan is not None:
+        return plan
+
+    with _compile_lock:
+        if name not in _compiled:
+            spec = resolve_layout(name)
+            slot_fields = set()
+            sections = {}
+            for section in SECTIONS:
+                sections[section] = [compile_item(item, section,
+                                                  slot_fields)
+                                     for item in spec.get(section, [])]
+
+            placeholders = dict(spec.get("placeholders", {}))
+            _compiled[name] = DrawPlan(name, sections, placeholders,
+                                       sorted(slot_fields))
+    return _compiled[name]
+
+def static_paragraph(para):
+    """ Shallow copy of a pre-wrapped paragraph. Drawing sets attributes
+    on the flowable, the copy keeps concurrent renders of the shared
+    plan apart.
+    """
+    return copy.copy(para)
@@ -0,0 +1,175 @@
+""" Loadtest - concurrency stress harness for the calibration report
+pipeline. Starts the application in a local multi-threaded waitress
+server, drives concurrent form submissions against it and verifies
+every generated pdf and thumbnail. Run from the directory containing
+reports/:
+
+    $VENV/bin/calibrationreport_loadtest --threads 1,2,4,8
+"""
+
+import os
+import sys
+import math
+import time
+import uuid
+import shutil
+import logging
+import argparse
+import threading
+
+try:
+    from urllib.request import urlopen
+    from urllib.parse import urlencode
+except ImportError: # pragma: no cover
+    from urllib2 import urlopen
+    from urllib import urlencode
+
+from webtest.http import StopableWSGIServer
+
+from calibrationreport.verify import data_signature
+
+log = logging.getLogger(__name__)
+
+def percentile(values, pct):
+    """ Nearest rank percentile of the list of values, None if it is
+    empty.
+    """
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+def submit_and_verify(base_url, serial, coefficients):
+    """ Post a completed form for the serial number and list of four
+    coefficients, then fetch the pdf and thumbnail it produced. Return
+    None if every output is valid and the pdf shows this submission,
+    a description of the first problem otherwise.
+    """
+    fields = {"submit": "submit", "serial": serial}
+    for index, value in enumerate(coefficients):
+        fields["coefficient_%s" % index] = value
+    post_data = urlencode(fields)
+    body = urlopen(base_url + "/", post_data.encode("ascii")).read()
+    if ("view_pdf/%s" % serial).encode("ascii") not in body:
+        return "%s: no report link in form response" % serial
+
+    pdf_data = urlopen("%s/view_pdf/%s" % (base_url, serial)).read()
+    if not pdf_data.startswith(b"%PDF"):
+        return "%s: invalid pdf" % serial
+
+    # Reports written over each other still parse, only their text
+    # tells whose they are
+    text = data_signature(pdf_data)["text"]
+    if serial not in "".join(text):
+        return "%s: pdf shows another serial" % serial
+
+    for index, value in enumerate(coefficients):
+        if "Coefficient C%s = %s" % (index, value) not in text:
+            return "%s: pdf shows other coefficients" % serial
+
+    png_data = urlopen("%s/view_thumbnail/%s" % (base_url, serial)).read()
+    if not png_data.startswith(b"\x89PNG"):
+        return "%s: invalid thumbnail" % serial
+
+    return None
+
+def run_load(app, threads, submissions, prefix="lt", keep=False):
+    """ Serve the application with the number of waitress threads
+    specified and submit reports from as many client threads. Return a
+    dictionary of the throughput in reports per second, p50 and p99
+    latency in seconds and the list of failures. Every run uses new
+    serial numbers, so reports kept from an earlier run are not skipped
+    as unchanged resubmissions.
+    """
+    server = StopableWSGIServer.create(app, threads=threads)
+    base_url = server.application_url.rstrip("/")
+
+    # Serial numbers are at most 10 characters
+    run_id = uuid.uuid4().hex[:4]
+    serials = ["%s%s%04d" % (prefix, run_id, index)
+               for index in range(submissions)]
+    pending = list(enumerate(serials))
+    lock = threading.Lock()
+    latencies = []
+    failures = []
+
+    def client():
+        """ Take serial numbers until none are left.
+        """
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index, serial = pending.pop()
+
+            # Coefficients unique to the submission, like its serial
+            coefficients = ["%s.%04d" % (value, index)
+                            for value in range(100, 104)]
+            start = time.time()
+            try:
+                problem = submit_and_verify(base_url, serial, coefficients)
+            except Exception as exc:
+                problem = "%s: %s" % (serial, exc)
+            elapsed = time.time() - start
+
+            with lock:
+                latencies.append(elapsed)
+                if problem is not None:
+                    failures.append(problem)
+
+    start = time.time()
+    clients = [threading.Thread(target=client) for _ in range(threads)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    total = time.time() - start
+
+    server.shutdown()
+    if not keep:
+        for serial in serials:
+            shutil.rmtree("reports/%s" % serial, ignore_errors=True)
+
+    return {"threads": threads, "submissions": submissions,
+            "throughput": submissions / total,
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "failures": failures}
+
+def main(argv=sys.argv):
+    """ Console script entry point, print a throughput and latency line
+    for each thread count.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--threads", default="1,2,4,8",
+                        help="comma separated waitress thread counts")
+    parser.add_argument("--submissions", type=int, default=40,
+                        help="reports to generate per thread count")
+    parser.add_argument("--config", default=None,
+                        help=".ini file to load the application from")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the generated reports")
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.WARN)
+    if args.config is not None:
+        from pyramid.paster import get_app
+        app = get_app(os.path.abspath(args.config))
+    else:
+        from calibrationreport import main as app_main
+        app = app_main({})
+
+    print("threads  reports/s  p50 (s)  p99 (s)  failures")
+    failed = False
+    for threads in [int(item) for item in args.threads.split(",")]:
+        result = run_load(app, threads, args.submissions, keep=args.keep)
+        print("%7d  %9.2f  %7.3f  %7.3f  %8d" % \
+              (threads, result["throughput"], result["p50"],
+               result["p99"], len(result["failures"])))
+        for problem in result["failures"]:
+            log.error(problem)
+            failed = True
+
+    return 1 if failed else 0
@@ -1,8 +1,12 @@
 """ datamodel objects used by the calibrationreport project.
 """
+import threading
+
 import colander
 from deform import widget, FileData
 
+from calibrationreport.layouts import LAYOUTS, DEFAULT_LAYOUT
+
 class EmptyReport(object):
     """ Helper class for empty calibration report population.
     """
@@ -14,6 +18,7 @@ class EmptyReport(object):
     coefficient_3 = ""
     top_image_filename = ""
     bottom_image_filename = ""
+    layout = DEFAULT_LAYOUT
 
 class MemoryTmpStore(dict):
     """ Instances of this class implement the
@@ -24,7 +29,40 @@ class MemoryTmpStore(dict):
     If you attempt to make tmpstore a class of FileUploadTempStore as
     described in the stack overflow entry below, it complains about
     the missing implementation of preview_url.
+
+    One store is shared by every request of the process, so an upload
+    is still available when the form is resubmitted after a validation
+    failure. Upload uids are random, access is guarded by a lock for
+    the waitress worker threads.
     """
+    def __init__(self, *args, **kwargs):
+        super(MemoryTmpStore, self).__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+    def __getitem__(self, uid):
+        """ Return the upload data of the uid.
+        """
+        with self.lock:
+            return super(MemoryTmpStore, self).__getitem__(uid)
+
+    def __setitem__(self, uid, value):
+        """ Store the upload data of the uid.
+        """
+        with self.lock:
+            super(MemoryTmpStore, self).__setitem__(uid, value)
+
+    def __contains__(self, uid):
+        """ True if the uid has upload data.
+        """
+        with self.lock:
+            return super(MemoryTmpStore, self).__contains__(uid)
+
+    def get(self, uid, default=None):
+        """ Return the upload data of the uid, default if there is none.
+        """
+        with self.lock:
+            return super(MemoryTmpStore, self).get(uid, default)
+
     def preview_url(self, uid):
         """ provide interface for schemanode
         """
@@ -48,6 +86,12 @@ class ReportSchema(colander.Schema):
 
     coefficient_3 = csn(colander.String())
 
+    layout_choices = [(name, name.upper()) for name in sorted(LAYOUTS)]
+    layout = csn(colander.String(),
+                 missing=DEFAULT_LAYOUT,
+                 validator=colander.OneOf(sorted(LAYOUTS)),
+                 widget=widget.SelectWidget(values=layout_choices))
+
     # Based on: # http://stackoverflow.com/questions/6563546/\
     # how-to-make-file-upload-facultative-with-deform-and-colander
     # Various demos delete this temporary file on succesful submission
@@ -4,184 +4,498 @@ photonics specific calibration reports.
 
 import os
 import time
+import shutil
+import hashlib
 import logging
+import tempfile
+import threading
+
+from io import BytesIO
+from collections import OrderedDict
 
-from reportlab.lib.units import mm
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import Image, Paragraph
-from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import Paragraph
 
 from wand.image import Image as WandImage
+from wand.exceptions import ResourceLimitError
 
 from calibrationreport.models import EmptyReport
+from calibrationreport.layouts import STYLES, compile_layout
+from calibrationreport.layouts import static_paragraph
+from calibrationreport.layouts import ImageOp, TextOp, SlotOp
+from calibrationreport.profiling import StageProfiler
 
 log = logging.getLogger(__name__)
 
+class ReportSizeError(Exception):
+    """ Raised when a saved report is larger than the size budget of
+    the output profile it was rendered with.
+    """
+    pass
+
+class OutputProfile(object):
+    """ Tuning knobs for the generated pdf. image_dpi is the maximum
+    effective resolution of product photos, jpeg_quality re-encodes them
+    as jpeg when set, and size_budget is the maximum saved report size
+    in bytes. The page streams are always compressed.
+    """
+    def __init__(self, name, image_dpi=72, jpeg_quality=None,
+                 size_budget=None):
+        self.name = name
+        self.image_dpi = image_dpi
+        self.jpeg_quality = jpeg_quality
+        self.size_budget = size_budget
+
+# The built in helvetica fonts used by the report are never embedded, so
+# there is nothing to subset. Product photos are the bulk of every
+# report, the header, footer and equation line art is drawn at one point
+# per pixel and embedded losslessly at its native resolution in every
+# profile.
+PROFILES = {
+    "archival": OutputProfile("archival", image_dpi=72,
+                              size_budget=256000),
+    "web": OutputProfile("web", image_dpi=60, jpeg_quality=85,
+                         size_budget=160000),
+    "minimal": OutputProfile("minimal", image_dpi=36, jpeg_quality=60,
+                             size_budget=128000),
+    }
+
+DEFAULT_PROFILE = "archival"
+
+# Profiles from largest to smallest output, the order to fall back in
+# when a report is over its size budget
+PROFILE_ORDER = ["archival", "web", "minimal"]
+
+# Calibration time drawn in deterministic mode, see verify.py
+DETERMINISTIC_TIMESTAMP = "Thu Jan  1 00:00:00 1970"
+
+# Prepared image blobs keyed by source content and profile, so static
+# resources and re-submitted uploads are only resized once per process.
+# Identical blobs hash to the same name in reportlab, which shares them
+# as a single XObject in the document. Least recently used entries are
+# dropped past IMAGE_CACHE_SIZE.
+IMAGE_CACHE_SIZE = 64
+_image_cache = OrderedDict()
+_image_cache_lock = threading.Lock()
+
+def get_profile(profile=None):
+    """ Return the OutputProfile for the name specified, the default
+    archival profile if None.
+    """
+    if profile is None:
+        profile = DEFAULT_PROFILE
+
+    if isinstance(profile, OutputProfile):
+        return profile
+
+    if profile not in PROFILES:
+        raise ValueError("Unknown output profile: %s" % profile)
+
+    return PROFILES[profile]
+
+def smaller_profile(profile=None):
+    """ Return the name of the next smaller profile in PROFILE_ORDER,
+    None if the profile is already the smallest or not one of PROFILES.
+    """
+    name = get_profile(profile).name
+    if name not in PROFILE_ORDER:
+        return None
+
+    index = PROFILE_ORDER.index(name) + 1
+    if index >= len(PROFILE_ORDER):
+        return None
+    return PROFILE_ORDER[index]
+
+def prepare_image(filename, profile, height=None, photo=False):
+    """ Load the image from disk and return a tuple of (blob, width,
+    height) where width and height are the drawing size in points. If
+    height is specified the image is drawn that many points high,
+    otherwise at one point per pixel of the original image. Photos with
+    more pixels per inch than the profile image_dpi are downsampled to
+    it and re-encoded as jpeg if the profile says so, everything else
+    keeps its source pixels.
+    """
+    key = (file_digest(filename), profile.name, height, photo)
+    with _image_cache_lock:
+        if key in _image_cache:
+            result = _image_cache.pop(key)
+            _image_cache[key] = result
+            return result
+
+    with WandImage(filename=filename) as img:
+        if height is None:
+            draw_width, draw_height = img.width, img.height
+        else:
+            draw_height = height
+            draw_width = img.width * float(height) / img.height
+
+        if photo:
+            # Never upsample, only drop the pixels the profile resolution
+            # can not show
+            scale = profile.image_dpi / 72.0
+            pixel_width = max(1, int(round(draw_width * scale)))
+            pixel_height = max(1, int(round(draw_height * scale)))
+            if pixel_width < img.width and pixel_height < img.height:
+                img.resize(pixel_width, pixel_height)
+
+        if photo and profile.jpeg_quality is not None:
+            img.format = "jpeg"
+            img.compression_quality = profile.jpeg_quality
+        else:
+            img.format = "png"
+
+        # Drop the creation dates and profiles, so the same input always
+        # produces the same bytes
+        img.strip()
+        blob = img.make_blob()
+
+    result = (blob, draw_width, draw_height)
+    with _image_cache_lock:
+        _image_cache[key] = result
+        while len(_image_cache) > IMAGE_CACHE_SIZE:
+            _image_cache.popitem(last=False)
+    return result
+
+def file_digest(filename):
+    """ Return the md5 hex digest of the file contents.
+    """
+    digest = hashlib.md5()
+    with open(filename, "rb") as in_file:
+        for chunk in iter(lambda: in_file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Thumbnail sizes in pixels. Medium is the original A4 ratio thumbnail
+# shown on the form page.
+THUMBNAIL_SIZES = {
+    "small": (248, 350),
+    "medium": (496, 701),
+    "large": (1240, 1753),
+    }
+
+THUMBNAIL_FORMATS = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    }
+
+# Variants of the form page thumbnail, view_thumbnail serves the webp
+# one to clients that accept it.
+PAGE_THUMBNAILS = [("medium", "png"), ("medium", "webp")]
+
+# Variants written whenever a report is generated, the first one is the
+# thumbnail returned by write_thumbnail.
+DEFAULT_THUMBNAILS = PAGE_THUMBNAILS + [("small", "webp"),
+                                        ("large", "png")]
+
+# Written in place of the thumbnails of a page over the ImageMagick
+# resource limits
+PLACEHOLDER_THUMBNAIL = "%s/../resources/thumbnail_start.png" \
+                        % os.path.dirname(__file__)
+
+def thumbnail_filename(pdf_filename, size="medium", fmt="png"):
+    """ Return the thumbnail filename for the size and format variant of
+    the pdf. The medium png keeps the historical report.png name.
+    """
+    base_name = pdf_filename.replace(".pdf", "")
+    if (size, fmt) == ("medium", "png"):
+        return "%s.png" % base_name
+    return "%s_%s.%s" % (base_name, size, fmt)
+
+def write_thumbnails(pdf_filename, variants=None):
+    """ Rasterize the first page of the pdf once, at a resolution that
+    covers the largest size requested, then write every (size, format)
+    variant to disk. Return the list of filenames written. If the page
+    is over the ImageMagick resource limits the placeholder thumbnail is
+    written as every variant instead, so the report stays viewable and
+    later views do not retry the rasterization.
+    """
+    if variants is None:
+        variants = DEFAULT_THUMBNAILS
+
+    for size, fmt in variants:
+        if size not in THUMBNAIL_SIZES or fmt not in THUMBNAIL_FORMATS:
+            raise ValueError("Unknown thumbnail: %s %s" % (size, fmt))
+
+    # The page is 612 points wide, at 72 points per inch
+    max_width = max([THUMBNAIL_SIZES[size][0] for size, fmt in variants])
+    density = max(72, int(72.0 * max_width / 612 + 0.5))
+
+    first_page_file = "%s[0]" % pdf_filename
+    try:
+        with WandImage(filename=first_page_file, resolution=density) as img:
+            filenames = write_variants(img, pdf_filename, variants)
+    except ResourceLimitError as exc:
+        log.warn("Thumbnail of %s over the limits, placeholder: %s",
+                 pdf_filename, exc)
+        with WandImage(filename=PLACEHOLDER_THUMBNAIL) as img:
+            return write_variants(img, pdf_filename, variants)
+
+    log.info("Generated thumbnails %s for %s", variants, pdf_filename)
+    return filenames
+
+def write_variants(img, pdf_filename, variants):
+    """ Resize and convert the image to every (size, format) variant and
+    write each one as that thumbnail of the pdf. Return the list of
+    filenames written.
+    """
+    filenames = []
+    out_dir = os.path.dirname(os.path.abspath(pdf_filename))
+    for size, fmt in variants:
+        out_filename = thumbnail_filename(pdf_filename, size, fmt)
+
+        # Write next to the destination and rename, so concurrent
+        # readers never see a partial thumbnail
+        handle, temp_filename = tempfile.mkstemp(suffix="." + fmt,
+                                                 dir=out_dir)
+        os.close(handle)
+        try:
+            with img.clone() as variant:
+                variant.resize(*THUMBNAIL_SIZES[size])
+                variant.format = fmt
+                variant.strip()
+                variant.save(filename=temp_filename)
+        except Exception:
+            os.remove(temp_filename)
+            raise
+        os.rename(temp_filename, out_filename)
+        filenames.append(out_filename)
+
+    return filenames
+
 class WasatchSinglePage(object):
     """ Generate a wasatch photoncis themed calibration report by
-    default. All parameters are optional.
+    default. All parameters are optional. The profile is one of the
+    names in PROFILES, or an OutputProfile. The layout is one of the
+    names in layouts.LAYOUTS, the report layout if not specified.
+    In deterministic mode the calibration time and the document ids
+    are fixed, so identical reports are byte for byte identical.
+
+    Every instance renders into its own scratch directory next to the
+    destination and only renames the finished pdf into place on save,
+    so any number of reports can be generated concurrently. With
+    return_blob the pdf is rendered in memory instead, so an instance
+    that is never saved leaves nothing on disk.
     """
     def __init__(self, filename="default.pdf", report=None,
-                 return_blob=False):
+                 return_blob=False, profile=None, layout=None,
+                 deterministic=False):
         self.dir_name = os.path.dirname(__file__)
         self.filename = filename
-        if return_blob == True:
-            self.filename = "%s/../resources/temp.pdf" % self.dir_name
 
         # Populate the report object with defaults if not specified
         if report is None:
             report = EmptyReport()
 
-        self.canvas = canvas.Canvas(self.filename, pagesize=letter)
-        self.styles = getSampleStyleSheet()
+        if layout is None:
+            layout = report.layout
+
+        # Both raise ValueError for unknown names, check them before
+        # there is a scratch directory to clean up
+        self.profile = get_profile(profile)
+        self.plan = compile_layout(layout)
+
+        if return_blob == True:
+            self.scratch_dir = None
+            self.temp_filename = BytesIO()
+        else:
+            out_dir = os.path.dirname(os.path.abspath(filename))
+            self.scratch_dir = tempfile.mkdtemp(prefix=".render_",
+                                                dir=out_dir)
+            self.temp_filename = "%s/render.pdf" % self.scratch_dir
+
+        self.profiler = StageProfiler()
+        self.timestamp = None
+        if deterministic:
+            self.timestamp = DETERMINISTIC_TIMESTAMP
+        self.canvas = canvas.Canvas(self.temp_filename, pagesize=letter,
+                                    pageCompression=1,
+                                    invariant=int(deterministic))
+        self.styles = STYLES
         self.width, self.height = letter
 
-        self.add_serial(report)
-        self.add_header_footer_images()
-        self.add_product_images(report)
-        self.add_coefficients(report)
+        try:
+            with self.profiler.stage("add_serial"):
+                self.add_serial(report)
+            with self.profiler.stage("add_header_footer_images"):
+                self.add_header_footer_images()
+            with self.profiler.stage("add_product_images"):
+                self.add_product_images(report)
+            with self.profiler.stage("add_coefficients"):
+                self.add_coefficients(report)
+        except Exception:
+            self.cleanup()
+            raise
+
         if not return_blob:
             log.info("Save: %s", self.filename)
-            self.canvas.save()
+            self.save()
+
+    def save(self):
+        """ Write the canvas to the scratch directory, enforce the size
+        budget of the output profile and move it to the destination
+        filename. In return_blob mode the canvas is only written to
+        memory.
+        """
+        try:
+            with self.profiler.stage("save"):
+                self.canvas.save()
+        except Exception:
+            self.cleanup()
+            raise
+
+        if self.scratch_dir is None:
+            actual_size = len(self.temp_filename.getvalue())
+        else:
+            actual_size = os.path.getsize(self.temp_filename)
+
+        budget = self.profile.size_budget
+        if budget is not None and actual_size > budget:
+            self.cleanup()
+            raise ReportSizeError("%s is %s bytes, %s budget is %s" \
+                                  % (self.filename, actual_size,
+                                     self.profile.name, budget))
+
+        if self.scratch_dir is None:
+            return
+
+        # Same filesystem rename, the new report appears atomically
+        os.rename(self.temp_filename, self.filename)
+        self.cleanup()
+
+    def cleanup(self):
+        """ Remove the scratch directory and everything left in it.
+        """
+        if self.scratch_dir is not None:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
     
     def return_blob(self):
         """ API compatibility to return generated blob data from qr
-        label temporarily writing to disk. If you have a solution with
-        tobytes, bytesio and encoder_name, please let me know.
+        label, rendered in memory.
         """
-        self.canvas.save()
-        temp_file = open(self.filename)
-        return temp_file.read()
+        self.save()
+        return self.temp_filename.getvalue()
 
     def return_thumbnail_blob(self):
         """ Write the canvas to pdf format as a temporary file. Read it
         back and png-ify the top page, return the blob.
         """
-        self.canvas.save()
+        blob_data = self.return_blob()
 
-        png_filename = self.filename.replace(".pdf", ".png")
-        first_page_file = "%s[0]" % self.filename
-        with WandImage(filename=first_page_file) as img:
-            img.resize(496, 701) # A4 ratio 2480x2408
-            img.save(filename=png_filename)
+        scratch_dir = tempfile.mkdtemp(prefix="calibrationreport_")
+        try:
+            pdf_filename = "%s/report.pdf" % scratch_dir
+            with open(pdf_filename, "wb") as temp_file:
+                temp_file.write(blob_data)
 
-        temp_file = open(png_filename)
-        return temp_file.read()
+            png_filename = write_thumbnails(pdf_filename,
+                                            [("medium", "png")])[0]
+            with open(png_filename, "rb") as temp_file:
+                return temp_file.read()
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
 
 
     def add_serial(self, report):
         """ Add the large serial number text and the calibration
         timestamp.
         """
-
-        serial_text = "<font size=62><i>%s</i></font>" % report.serial
-        self.create_paragraph(serial_text, 20, 65)
-
-        time_txt = "Calibrated by: Auto-Calibrated on %s" % time.ctime()
-        self.create_paragraph(time_txt, 20, 100)
-
+        self.draw_section("serial", report)
 
     def add_header_footer_images(self):
         """ Load the header, footer and side by side imagery .
         """
-
-        # Add the header images
-        img_name = "%s/../resources/calibration_report_header.png" \
-                   % self.dir_name
-        img_head = Image(img_name)
-        img_head.drawOn(self.canvas, *self.coord(0, 48, mm))
-
-        img_name = "%s/../resources/calibration_report_footer.png" \
-                   % self.dir_name
-        img_foot = Image(img_name)
-        img_foot.drawOn(self.canvas, *self.coord(0, 280, mm))
-
+        self.draw_section("header_footer")
 
     def add_product_images(self, report):
         """ Check if the specified imagery exists, load it into the
         canvas if it is available.
         """
-        top_found = os.path.exists(report.top_image_filename)
-        bot_found = os.path.exists(report.bottom_image_filename)
+        products = self.plan.sections["product_images"]
+        filenames = [getattr(report, product.field)
+                     for product in products]
 
-        log.info("Add image: %s, %s", report.top_image_filename, report.bottom_image_filename)
-        if not top_found or not bot_found:
+        log.info("Add image: %s", filenames)
+        if not all([os.path.exists(name) for name in filenames]):
             log.warn("Not adding unavailable product images")
             return
 
         # Resize the images with wand first so they will fit in the
         # document as expected. The output size when height scaled to
-        # 125px will be close to 300x175 when viewed in the pdf.
-        orig_image0_filename = report.top_image_filename
-        orig_image1_filename = report.bottom_image_filename
-
-        image0_filename = "temp_image0.png"
-        image1_filename = "temp_image1.png"
-        with WandImage(filename=orig_image0_filename) as img:
-            img.transform(resize="x125")
-            img.save(filename=image0_filename)
-
-        with WandImage(filename=orig_image1_filename) as img:
-            img.transform(resize="x125")
-            img.save(filename=image1_filename)
-
-        # Reload the scaled images, draw with absolute coordinates
-        img_zero = Image(image0_filename)
-        img_one = Image(image1_filename)
-
-        img_zero.drawOn(self.canvas, *self.coord(135, 100, mm))
-        img_one.drawOn(self.canvas, *self.coord(135, 150, mm))
-        
-    def coord(self, input_x, input_y, unit=1):
-        """ Helper class to help position flowables in Canvas objects
-        From: http://www.blog.pythonlibrary.org/2012/06/27/\
-        reportlab-mixing-fixed-content-and-flowables/
-        """
-        out_x, out_y = input_x * unit, self.height -  input_y * unit
-        return out_x, out_y    
- 
-    def create_paragraph(self, ptext, input_x, input_y, style=None):
-        """ From: http://www.blog.pythonlibrary.org/2012/06/27/\
-        reportlab-mixing-fixed-content-and-flowables/
-        """
-        if not style:
-            style = self.styles["Normal"]
-        para = Paragraph(ptext, style=style)
-        para.wrapOn(self.canvas, self.width, self.height)
-        para.drawOn(self.canvas, *self.coord(input_x, input_y, mm))
+        # 125 points will be close to 300x175 when viewed in the pdf.
+        # All are prepared before drawing any, so uploads too large
+        # for the ImageMagick resource limits are left out together
+        # rather than failing the whole report.
+        try:
+            for filename, product in zip(filenames, products):
+                prepare_image(filename, self.profile, product.height,
+                              True)
+        except ResourceLimitError as exc:
+            log.warn("Not adding product images over the limits: %s", exc)
+            return
+
+        for filename, product in zip(filenames, products):
+            self.draw_image(filename, product.x, product.y,
+                            product.height, photo=True)
 
     def add_coefficients(self, report):
         """ Add the calibration equation image, as well as the
         calibration coefficients defined in the report object.
         """
-        img_name = "%s/../resources/calibration_text_and_equation.png" \
-                   % self.dir_name
-        img_equ = Image(img_name)
-        img_equ.drawOn(self.canvas, *self.coord(40, 180, mm)) 
-
-        pfx_txt = "Where 'p' is pixel index, and:"
-        self.create_paragraph(pfx_txt, 60, 190)
-
-        c0_txt = "Coefficient <b>C0 =</b> %s" % report.coefficient_0
-        self.create_paragraph(c0_txt, 60, 200)
-        c1_txt = "Coefficient <b>C1 =</b> %s" % report.coefficient_1
-        self.create_paragraph(c1_txt, 60, 208)
-        c2_txt = "Coefficient <b>C2 =</b> %s" % report.coefficient_2
-        self.create_paragraph(c2_txt, 60, 216) 
-        c3_txt = "Coefficient <b>C3 =</b> %s" % report.coefficient_3
-        self.create_paragraph(c3_txt, 60, 224)
-
-
-    def write_thumbnail(self):
-        """ Reload the file written to disk in init, generate a png of
-        the top page, write it to disk and return the filename.
+        self.draw_section("coefficients", report)
+
+    def draw_section(self, section, report=None):
+        """ Draw the images, static text and report filled slots of the
+        layout section.
         """
-        png_filename = self.filename.replace(".pdf", ".png")
-        first_page_file = "%s[0]" % self.filename
-        with WandImage(filename=first_page_file) as img:
-            img.resize(496, 701) # A4 ratio 2480x2408
-            img.save(filename=png_filename)
-
-        log.info("Generated top thumbnail for %s", self.filename)
-        return png_filename
+        values = None
+        for operation in self.plan.sections[section]:
+            if isinstance(operation, ImageOp):
+                self.draw_image(operation.filename, operation.x,
+                                operation.y)
+
+            elif isinstance(operation, TextOp):
+                para = static_paragraph(operation.para)
+                para.drawOn(self.canvas, operation.x, operation.y)
+
+            elif isinstance(operation, SlotOp):
+                if values is None:
+                    values = self.slot_values(report)
+                para = Paragraph(operation.template % values,
+                                 style=operation.style)
+                para.wrapOn(self.canvas, self.width, self.height)
+                para.drawOn(self.canvas, operation.x, operation.y)
+
+    def slot_values(self, report):
+        """ Return the dictionary of report fields used by the layout
+        slots, with the calibration timestamp.
+        """
+        values = {"timestamp": self.timestamp or time.ctime()}
+        for field in self.plan.slot_fields:
+            if field not in values:
+                values[field] = getattr(report, field)
+        return values
+
+    def draw_image(self, filename, pos_x, pos_y, height=None,
+                   photo=False):
+        """ Draw the profile prepared image with its lower left corner
+        at the absolute point coordinates specified.
+        """
+        blob, width, height = prepare_image(filename, self.profile,
+                                            height, photo)
+        reader = ImageReader(BytesIO(blob))
+        self.canvas.drawImage(reader, pos_x, pos_y, width, height,
+                              mask="auto")
+        
+    def write_thumbnail(self, variants=None):
+        """ Reload the file written to disk in init, generate the
+        thumbnail variants of the top page in one pass, write them to
+        disk and return the filename of the first one, the medium png
+        by default.
+        """
+        with self.profiler.stage("write_thumbnail"):
+            filenames = write_thumbnails(self.filename, variants)
+
+        return filenames[0]
@@ -0,0 +1,195 @@
+""" Profiling - opt-in memory profiling of requests and report
+generation stages, and ImageMagick resource limits. Both are configured
+from the .ini file, see config/development.ini.
+"""
+
+import os
+import re
+import time
+import logging
+import resource
+import contextlib
+
+try:
+    import tracemalloc
+except ImportError: # pragma: no cover
+    tracemalloc = None
+
+try:
+    from wand.resource import limits as magick_limits
+except ImportError: # pragma: no cover
+    magick_limits = None
+
+log = logging.getLogger(__name__)
+
+# Set by enable(), checked on every stage and request so the profiling
+# costs nothing when it is off.
+_enabled = False
+
+# Settings prefix and the ImageMagick resource each one limits
+MAGICK_LIMITS = {
+    "calibrationreport.magick.memory": "memory",
+    "calibrationreport.magick.map": "map",
+    "calibrationreport.magick.area": "area",
+    "calibrationreport.magick.disk": "disk",
+    "calibrationreport.magick.thread": "thread",
+    }
+
+SIZE_UNITS = {"": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+def enable():
+    """ Turn on profiling for the process. tracemalloc is only tracing
+    python allocations, wand and ImageMagick allocate natively and only
+    show up in the rss deltas.
+    """
+    global _enabled
+    _enabled = True
+    if tracemalloc is None:
+        log.warn("tracemalloc is not available on this python, only rss "
+                 "deltas are profiled")
+    elif not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    """ Turn off profiling for the process.
+    """
+    global _enabled
+    _enabled = False
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def is_enabled():
+    """ True if enable() has been called.
+    """
+    return _enabled
+
+def current_rss():
+    """ Resident set size of the process in bytes. Uses /proc where it
+    is available, the peak rss from getrusage otherwise.
+    """
+    try:
+        with open("/proc/self/statm") as in_file:
+            pages = int(in_file.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def start_sample():
+    """ Return the starting point of a measurement. The tracemalloc peak
+    is never reset, that would also clear the peak of the measurements
+    running in other threads.
+    """
+    traced = peak = None
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        traced, peak = tracemalloc.get_traced_memory()
+    return time.time(), current_rss(), traced, peak
+
+def end_sample(name, start):
+    """ Return a dictionary describing the measurement from start.
+    traced_delta is the net change of the memory traced by tracemalloc.
+    peak_growth is how far the new tracemalloc peak is above the traced
+    memory at the start, if the measured code raised the peak. The peak
+    is kept for the life of the process, so when an earlier peak was
+    higher the peak of this measurement is unknown and peak_growth is
+    None. Both are None if python is not tracing allocations. All the
+    numbers are process wide, with several waitress threads they include
+    whatever the other threads allocated in the meantime.
+    """
+    start_time, start_rss, start_traced, start_peak = start
+    growth = delta = None
+    if start_traced is not None and tracemalloc.is_tracing():
+        traced, peak = tracemalloc.get_traced_memory()
+        delta = traced - start_traced
+        if peak > start_peak:
+            growth = peak - start_traced
+
+    return {"name": name, "seconds": time.time() - start_time,
+            "peak_growth": growth, "traced_delta": delta,
+            "rss_delta": current_rss() - start_rss}
+
+def describe(sample):
+    """ Return the log line summary of a measurement, without the
+    tracemalloc numbers when they were not measured.
+    """
+    text = "%(seconds).3fs, rss delta %(rss_delta)s" % sample
+    if sample["peak_growth"] is not None:
+        text += ", tracemalloc peak growth %s" % sample["peak_growth"]
+    elif sample["traced_delta"] is not None:
+        text += ", no new tracemalloc peak, traced delta %s" \
+                % sample["traced_delta"]
+    return text
+
+class StageProfiler(object):
+    """ Record a measurement for each named stage of a report. Does
+    nothing unless profiling has been enabled.
+    """
+    def __init__(self):
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager to measure the enclosed stage.
+        """
+        if not _enabled:
+            yield
+            return
+
+        start = start_sample()
+        try:
+            yield
+        finally:
+            sample = end_sample(name, start)
+            self.stages.append(sample)
+            log.info("Stage %s: %s", name, describe(sample))
+
+def memory_tween_factory(handler, registry):
+    """ Pyramid tween to log the memory used by each request when
+    profiling is enabled.
+    """
+    def memory_tween(request):
+        """ Measure the request from start to response.
+        """
+        if not _enabled:
+            return handler(request)
+
+        start = start_sample()
+        try:
+            return handler(request)
+        finally:
+            sample = end_sample(request.path, start)
+            log.info("Request %s: %s", request.path, describe(sample))
+
+    return memory_tween
+
+def parse_size(value):
+    """ Convert a settings value like 256MB to a number of bytes.
+    Plain numbers are used as they are, which is what the thread limit
+    expects.
+    """
+    match = re.match(r"^\s*(\d+)\s*([KMG]B)?\s*$", str(value).upper())
+    if match is None:
+        raise ValueError("Invalid resource limit: %s" % value)
+
+    number, unit = match.groups()
+    return int(number) * SIZE_UNITS[unit or ""]
+
+def apply_magick_limits(settings):
+    """ Set the ImageMagick resource limits found in the settings. When
+    a limit is hit wand raises a ResourceLimitError for that image
+    instead of the worker running out of memory. Return the dictionary
+    of limits applied.
+    """
+    applied = {}
+    for key, name in sorted(MAGICK_LIMITS.items()):
+        if key not in settings:
+            continue
+
+        if magick_limits is None:
+            log.warn("This wand version can not set resource limits")
+            return {}
+
+        applied[name] = parse_size(settings[key])
+        magick_limits[name] = applied[name]
+        log.info("ImageMagick %s limit: %s", name, applied[name])
+
+    return applied
@@ -0,0 +1,126 @@
+""" Regenerate - track the inputs of each report so a re-submission only
+re-runs the pipeline stages whose inputs changed, and report which
+stages were skipped and roughly how much time that saved.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import contextlib
+
+from calibrationreport.pdfgenerator import THUMBNAIL_SIZES
+from calibrationreport.pdfgenerator import THUMBNAIL_FORMATS
+from calibrationreport.pdfgenerator import thumbnail_filename
+
+log = logging.getLogger(__name__)
+
+def stream_digest(file_pointer):
+    """ Return the md5 hex digest of everything readable from the file
+    pointer, leaving it rewound.
+    """
+    digest = hashlib.md5()
+    file_pointer.seek(0)
+    for chunk in iter(lambda: file_pointer.read(65536), b""):
+        digest.update(chunk)
+    file_pointer.seek(0)
+    return digest.hexdigest()
+
+def fingerprint(*values):
+    """ Return a digest of the values, for comparing sets of inputs.
+    """
+    text = json.dumps([str(value) for value in values])
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+def remove_thumbnails(pdf_filename, keep):
+    """ Remove every thumbnail variant of the pdf except the (size,
+    format) variants in keep. They are regenerated on first view.
+    """
+    for size in THUMBNAIL_SIZES:
+        for fmt in THUMBNAIL_FORMATS:
+            filename = thumbnail_filename(pdf_filename, size, fmt)
+            if (size, fmt) not in keep and os.path.exists(filename):
+                os.remove(filename)
+
+class Regeneration(object):
+    """ Inputs and stage timings of one report submission. The
+    fingerprints and timings of the last submission are kept in
+    inputs.json in the report directory.
+    """
+    def __init__(self, report_dir):
+        self.filename = "%s/inputs.json" % report_dir
+        self.previous = {"fingerprints": {}, "timings": {}}
+        if os.path.exists(self.filename):
+            with open(self.filename) as in_file:
+                self.previous = json.load(in_file)
+
+        self.fingerprints = {}
+        self.timings = {}
+        self.skipped = []
+        self.saved = {}
+
+    def changed(self, key, value):
+        """ Record the fingerprint of an input, return True if it is
+        different from the last submission.
+        """
+        self.fingerprints[key] = value
+        return self.previous["fingerprints"].get(key) != value
+
+    def last_timing(self, name):
+        """ Duration of the stage the last time it ran, 0 if it never
+        has.
+        """
+        return self.previous["timings"].get(name, 0.0)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager to time a stage that runs.
+        """
+        start = time.time()
+        yield
+        self.timings[name] = time.time() - start
+
+    def skip(self, name, saved=None):
+        """ Record a stage that did not need to run. The time saved is
+        its last measured duration unless specified.
+        """
+        if saved is None:
+            saved = self.last_timing(name)
+        self.skipped.append(name)
+        self.saved[name] = saved
+
+    def time_saved(self):
+        """ Estimated seconds saved by the skipped stages.
+        """
+        return sum(self.saved.values())
+
+    def summary(self):
+        """ Dictionary of the stages that ran and were skipped, and the
+        estimated time saved in seconds.
+        """
+        return {"ran": sorted(self.timings), "skipped": self.skipped,
+                "time_saved": self.time_saved()}
+
+    def save(self):
+        """ Write the fingerprints and the timings of the stages that
+        ran, keeping earlier timings of skipped stages for the next
+        estimate.
+        """
+        fingerprints = dict(self.previous["fingerprints"])
+        fingerprints.update(self.fingerprints)
+        timings = dict(self.previous["timings"])
+        timings.update(self.timings)
+
+        handle, temp_filename = tempfile.mkstemp(suffix=".json",
+                                    dir=os.path.dirname(self.filename))
+        with os.fdopen(handle, "w") as out_file:
+            json.dump({"fingerprints": fingerprints, "timings": timings},
+                      out_file)
+        os.rename(temp_filename, self.filename)
+
+        summary = self.summary()
+        log.info("Regenerated %s: ran %s, skipped %s, saved %.3fs",
+                 os.path.dirname(self.filename), summary["ran"],
+                 summary["skipped"], summary["time_saved"])
@@ -0,0 +1,368 @@
+""" Verify - structural comparison of generated reports against golden
+outputs. Pdfs are compared by page count, extracted page text and the
+decoded pixels of every embedded image, thumbnails by dimensions and
+pixels. Pixels only have to match within PIXEL_TOLERANCE, so golden
+outputs stay valid across zlib, ImageMagick and Ghostscript versions.
+Render both sides with WasatchSinglePage in deterministic mode so the
+timestamp and document ids match:
+
+    $VENV/bin/calibrationreport_verify --golden-pdf old/report.pdf \
+        new/*/report.pdf
+
+The golden outputs are the deterministic render of golden_report(). Run
+this after any intended change to the report and commit the result:
+
+    $VENV/bin/calibrationreport_verify --regenerate
+"""
+
+import os
+import re
+import sys
+import zlib
+import hashlib
+import logging
+import argparse
+
+from reportlab.lib.rl_accel import asciiBase85Decode
+
+from wand.image import Image as WandImage
+
+from calibrationreport.models import EmptyReport
+from calibrationreport.layouts import compile_layout
+from calibrationreport.pdfgenerator import WasatchSinglePage
+
+log = logging.getLogger(__name__)
+
+RESOURCES_DIR = "%s/../resources" % os.path.dirname(__file__)
+
+KNOWN_REPORT = "%s/known_report.pdf" % RESOURCES_DIR
+KNOWN_THUMBNAIL = "%s/known_thumbnail.png" % RESOURCES_DIR
+
+STREAM = re.compile(br">>\s*stream\r?\n")
+LENGTH = re.compile(br"/Length\s+(\d+)")
+FILTERS = re.compile(br"/(ASCII85Decode|FlateDecode|DCTDecode)")
+DIMENSIONS = re.compile(br"/(Width|Height)\s+(\d+)")
+PAGE = re.compile(br"/Type\s*/Page(?!s)")
+TEXT_BLOCK = re.compile(br"BT(.*?)ET", re.DOTALL)
+TEXT_TOKEN = re.compile(br"\(((?:\\.|[^\\()])*)\)\s*Tj|T\*|\[(.*?)\]\s*TJ",
+                        re.DOTALL)
+LITERAL = re.compile(br"\(((?:\\.|[^\\()])*)\)")
+ESCAPE = re.compile(br"\\([0-7]{1,3}|.)", re.DOTALL)
+
+ESCAPES = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b",
+           b"f": b"\f"}
+
+# Largest root mean square pixel difference, as a fraction of the full
+# intensity range, of images that still match. Resampling and
+# antialiasing differences between library versions stay well below it,
+# a different page or image is far above.
+PIXEL_TOLERANCE = 0.03
+
+# Signatures of golden files keyed by filename and modification time,
+# so a batch only parses each golden file once
+_golden_cache = {}
+
+def pdf_streams(data):
+    """ Yield a tuple of (dictionary, raw stream bytes) for every stream
+    object in the pdf data. The stream length is taken from the
+    dictionary, so binary data can not be mistaken for a keyword.
+    """
+    position = 0
+    while True:
+        match = STREAM.search(data, position)
+        if match is None:
+            return
+
+        start = data.rfind(b" obj", 0, match.start())
+        dictionary = data[start:match.start() + 2]
+        length = LENGTH.search(dictionary)
+        if length is None:
+            position = match.end()
+            continue
+
+        end = match.end() + int(length.group(1))
+        yield dictionary, data[match.end():end]
+        position = end
+
+def decode_stream(dictionary, raw):
+    """ Undo the ascii85 and flate filters of a content stream.
+    """
+    for name in FILTERS.findall(dictionary):
+        if name == b"ASCII85Decode":
+            raw = asciiBase85Decode(raw.strip().decode("latin-1"))
+            if not isinstance(raw, bytes): # pragma: no cover
+                raw = raw.encode("latin-1")
+        elif name == b"FlateDecode":
+            raw = zlib.decompress(raw)
+    return raw
+
+def unescape(literal):
+    """ Convert the escapes of a pdf literal string.
+    """
+    def replace(match):
+        """ Replace a single escape sequence.
+        """
+        code = match.group(1)
+        if code.isdigit():
+            return bytes(bytearray([int(code, 8) & 0xff]))
+        return ESCAPES.get(code, code)
+    return ESCAPE.sub(replace, literal)
+
+def extract_text(content):
+    """ Return the list of text lines drawn by a decoded content stream,
+    in drawing order. Fragments in different fonts on the same line are
+    joined.
+    """
+    lines = []
+    for block in TEXT_BLOCK.findall(content):
+        fragments = []
+        for match in TEXT_TOKEN.finditer(block):
+            if match.group(0) == b"T*":
+                lines.append(b"".join(fragments))
+                fragments = []
+            elif match.group(1) is not None:
+                fragments.append(unescape(match.group(1)))
+            else:
+                fragments.extend([unescape(item) for item
+                                  in LITERAL.findall(match.group(2))])
+        lines.append(b"".join(fragments))
+
+    return [line.decode("latin-1") for line in lines if line]
+
+def pdf_signature(filename):
+    """ Return a dictionary of the page count, text lines and sorted
+    image content hashes of the pdf.
+    """
+    with open(filename, "rb") as in_file:
+        return data_signature(in_file.read())
+
+def data_signature(data):
+    """ Return the pdf_signature of the pdf data. Images are hashed
+    after their flate and ascii85 filters are undone, so the hash is of
+    the pixels rather than the compressor output, jpeg images are hashed
+    as encoded. The decoded pixels are kept by image for compare_pdf.
+    """
+    text = []
+    images = []
+    pixels = {}
+    for dictionary, raw in pdf_streams(data):
+        if b"/Subtype /Image" in dictionary:
+            dimensions = dict(DIMENSIONS.findall(dictionary))
+            decoded = decode_stream(dictionary, raw)
+            image = "%sx%s:%s" % (int(dimensions.get(b"Width", 0)),
+                                  int(dimensions.get(b"Height", 0)),
+                                  hashlib.md5(decoded).hexdigest())
+            images.append(image)
+            if b"/DCTDecode" not in dictionary:
+                pixels[image] = decoded
+        elif b"/Subtype" not in dictionary:
+            text.extend(extract_text(decode_stream(dictionary, raw)))
+
+    return {"pages": len(PAGE.findall(data)), "text": text,
+            "images": sorted(images), "pixels": pixels}
+
+def pixel_distance(first, second):
+    """ Root mean square difference of two equally long pixel buffers,
+    as a fraction of the full intensity range. None if the lengths
+    differ.
+    """
+    if len(first) != len(second):
+        return None
+    if not first:
+        return 0.0
+
+    first = bytearray(first)
+    second = bytearray(second)
+    total = sum([(a - b) ** 2 for a, b in zip(first, second)])
+    return (float(total) / len(first)) ** 0.5 / 255
+
+def image_signature(filename):
+    """ Return a dictionary of the dimensions and pixel hash of the
+    image. Metadata and encoder differences do not change the hash.
+    """
+    with WandImage(filename=filename) as img:
+        return {"width": img.width, "height": img.height,
+                "pixels": img.signature}
+
+def golden_signature(filename, signature_function):
+    """ Return the cached signature of a golden file.
+    """
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key not in _golden_cache:
+        _golden_cache[key] = signature_function(filename)
+    return _golden_cache[key]
+
+def compare_pdf(actual, expected=KNOWN_REPORT, ignore=()):
+    """ Return the list of differences between the actual and expected
+    pdfs, empty if they match. Text lines matching any of the ignore
+    regular expressions are left out of the comparison.
+    """
+    actual_sig = pdf_signature(actual)
+    expected_sig = golden_signature(expected, pdf_signature)
+
+    differences = []
+    if actual_sig["pages"] != expected_sig["pages"]:
+        differences.append("pages: %s != %s" % (actual_sig["pages"],
+                                                expected_sig["pages"]))
+
+    patterns = [re.compile(pattern) for pattern in ignore]
+    def kept(lines):
+        """ Text lines not matching any ignore pattern.
+        """
+        return [line for line in lines
+                if not any([pattern.search(line) for pattern in patterns])]
+
+    actual_text = kept(actual_sig["text"])
+    expected_text = kept(expected_sig["text"])
+    for line in expected_text:
+        if line not in actual_text:
+            differences.append("missing text: %s" % line)
+    for line in actual_text:
+        if line not in expected_text:
+            differences.append("unexpected text: %s" % line)
+
+    missing, extra = image_differences(actual_sig, expected_sig)
+    if missing or extra:
+        differences.append("images: %s missing, %s unexpected" \
+                           % (len(missing), len(extra)))
+
+    return differences
+
+def image_differences(actual_sig, expected_sig):
+    """ Return the lists of expected images missing from the actual pdf
+    signature and of its unexpected images. An image that is not
+    identical still matches an expected image of the same dimensions if
+    their decoded pixels are within PIXEL_TOLERANCE.
+    """
+    missing = list(expected_sig["images"])
+    extra = []
+    for image in actual_sig["images"]:
+        if image in missing:
+            missing.remove(image)
+        else:
+            extra.append(image)
+
+    for image in list(extra):
+        size = image.split(":")[0]
+        for golden in missing:
+            if golden.split(":")[0] != size:
+                continue
+
+            first = actual_sig["pixels"].get(image)
+            second = expected_sig["pixels"].get(golden)
+            if first is None or second is None:
+                continue
+
+            distance = pixel_distance(first, second)
+            if distance is not None and distance <= PIXEL_TOLERANCE:
+                missing.remove(golden)
+                extra.remove(image)
+                break
+
+    return missing, extra
+
+def compare_thumbnail(actual, expected=KNOWN_THUMBNAIL):
+    """ Return the list of differences between the actual and expected
+    thumbnails, empty if they have the same dimensions and their pixels
+    are within PIXEL_TOLERANCE.
+    """
+    differences = []
+    with WandImage(filename=actual) as img:
+        with WandImage(filename=expected) as golden:
+            for key in ["width", "height"]:
+                if getattr(img, key) != getattr(golden, key):
+                    differences.append("%s: %s != %s" \
+                                       % (key, getattr(img, key),
+                                          getattr(golden, key)))
+            if differences:
+                return differences
+
+            compared, distortion = img.compare(golden,
+                                               metric="root_mean_square")
+            compared.close()
+            if distortion > PIXEL_TOLERANCE:
+                differences.append("pixels: %.4f rms, tolerance %s" \
+                                   % (distortion, PIXEL_TOLERANCE))
+    return differences
+
+def verify_batch(filenames, golden_pdf=KNOWN_REPORT,
+                 golden_thumbnail=KNOWN_THUMBNAIL, ignore=()):
+    """ Compare every pdf and png in filenames with the matching golden
+    file. Return a dictionary of filename to its list of differences,
+    only for the files that differ.
+    """
+    failures = {}
+    for filename in filenames:
+        if filename.endswith(".pdf"):
+            differences = compare_pdf(filename, golden_pdf, ignore)
+        else:
+            differences = compare_thumbnail(filename, golden_thumbnail)
+
+        if differences:
+            failures[filename] = differences
+    return failures
+
+def golden_report():
+    """ Return the report the golden outputs are rendered from, with
+    the placeholder product images of the default layout.
+    """
+    report = EmptyReport()
+    report.serial = "ft789"
+    report.coefficient_0 = "100"
+    report.coefficient_1 = "101"
+    report.coefficient_2 = "102"
+    report.coefficient_3 = "103"
+
+    placeholders = compile_layout(report.layout).placeholders
+    report.top_image_filename = "%s/../%s" \
+        % (RESOURCES_DIR, placeholders["top_image_filename"])
+    report.bottom_image_filename = "%s/../%s" \
+        % (RESOURCES_DIR, placeholders["bottom_image_filename"])
+    return report
+
+def write_goldens(golden_pdf=KNOWN_REPORT,
+                  golden_thumbnail=KNOWN_THUMBNAIL):
+    """ Render golden_report() in deterministic mode with the default
+    profile and write it and its medium png thumbnail as the golden
+    outputs.
+    """
+    pdf = WasatchSinglePage(filename=golden_pdf, report=golden_report(),
+                            deterministic=True)
+    os.rename(pdf.write_thumbnail([("medium", "png")]), golden_thumbnail)
+    log.info("Wrote golden outputs %s and %s", golden_pdf,
+             golden_thumbnail)
+
+def main(argv=sys.argv):
+    """ Console script entry point, print the differences of each file
+    and exit non-zero if any file does not match.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("filenames", nargs="*",
+                        help="pdf and png files to verify")
+    parser.add_argument("--golden-pdf", default=KNOWN_REPORT)
+    parser.add_argument("--golden-thumbnail", default=KNOWN_THUMBNAIL)
+    parser.add_argument("--ignore", action="append", default=[],
+                        help="regular expression of text lines to skip")
+    parser.add_argument("--regenerate", action="store_true",
+                        help="write the golden outputs from the current "
+                             "code instead of verifying")
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.WARN)
+    if args.regenerate:
+        write_goldens(args.golden_pdf, args.golden_thumbnail)
+        return 0
+
+    if not args.filenames:
+        parser.error("no files to verify")
+
+    failures = verify_batch(args.filenames, args.golden_pdf,
+                            args.golden_thumbnail, args.ignore)
+    for filename in sorted(failures):
+        print(filename)
+        for difference in failures[filename]:
+            print("    %s" % difference)
+
+    print("%s of %s files match" % (len(args.filenames) - len(failures),
+                                    len(args.filenames)))
+    return 1 if failures else 0
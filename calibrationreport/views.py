@@ -3,9 +3,11 @@
 import os
 import shutil
 import logging
+import tempfile
 
 from pyramid.response import FileResponse
 from pyramid.view import view_config
+from pyramid.httpexceptions import HTTPNotFound
 
 import colander
 
@@ -15,10 +17,47 @@ from deform.exception import ValidationFailure
 from slugify import slugify
 
 from calibrationreport.pdfgenerator import WasatchSinglePage
+from calibrationreport.pdfgenerator import ReportSizeError
+from calibrationreport.pdfgenerator import smaller_profile
+from calibrationreport.pdfgenerator import THUMBNAIL_SIZES
+from calibrationreport.pdfgenerator import THUMBNAIL_FORMATS
+from calibrationreport.pdfgenerator import thumbnail_filename
+from calibrationreport.pdfgenerator import DEFAULT_THUMBNAILS
+from calibrationreport.pdfgenerator import PAGE_THUMBNAILS
+from calibrationreport.pdfgenerator import write_thumbnails
+from calibrationreport.gallery import gallery_page, sprite_filename
+from calibrationreport.gallery import sprite_version
+from calibrationreport.bundle import ASSETS_DIR, CONTENT_TYPES, ENCODINGS
 from calibrationreport.models import EmptyReport, ReportSchema
+from calibrationreport.layouts import compile_layout
+from calibrationreport.pdfgenerator import file_digest
+from calibrationreport.regenerate import Regeneration, fingerprint
+from calibrationreport.regenerate import stream_digest, remove_thumbnails
 
 log = logging.getLogger(__name__)
 
+def header_qualities(header):
+    """ Parse an Accept style header into a dictionary of the lower case
+    media types or content codings listed to their quality values.
+    """
+    qualities = {}
+    for item in header.split(","):
+        params = item.split(";")
+        value = params[0].strip().lower()
+        if not value:
+            continue
+
+        quality = 1.0
+        for param in params[1:]:
+            name, _, number = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        qualities[value] = quality
+    return qualities
+
 class CalibrationReportViews(object):
     """ Generate pdf and png content of calibration reports based on
     fields supplied by the user.
@@ -29,11 +68,136 @@ class CalibrationReportViews(object):
     @view_config(route_name="view_thumbnail")
     def view_thumbnail(self):
         """ If the matchdict specified serial number directory has a
-        first page calibration report png thumbnail, return it.
+        first page calibration report thumbnail, return it. The size and
+        format request parameters select the variant, the format
+        defaults to webp if the client accepts it and png otherwise.
+        Variants that have not been written yet are generated from the
+        report pdf and kept on disk.
         """
         serial = slugify(self.request.matchdict["serial"])
-        filename = "reports/%s/report.png" % serial
-        return FileResponse(filename)
+        size = self.request.params.get("size", "medium")
+        fmt = self.request.params.get("format")
+        if fmt is None:
+            # Only clients that list webp by name get it, the wildcards
+            # sent by every browser say nothing about webp support
+            qualities = header_qualities(self.request.headers.get("Accept",
+                                                                  ""))
+            webp = qualities.get("image/webp", 0)
+            png = qualities.get("image/png", qualities.get("image/*",
+                                qualities.get("*/*", 0)))
+            fmt = "png"
+            if webp > 0 and webp >= png:
+                fmt = "webp"
+
+        if size not in THUMBNAIL_SIZES or fmt not in THUMBNAIL_FORMATS:
+            return HTTPNotFound()
+
+        pdf_filename = "reports/%s/report.pdf" % serial
+        filename = thumbnail_filename(pdf_filename, size, fmt)
+        if not os.path.exists(filename):
+            if not os.path.exists(pdf_filename):
+                return HTTPNotFound()
+            write_thumbnails(pdf_filename, [(size, fmt)])
+
+        response = FileResponse(filename,
+                                content_type=THUMBNAIL_FORMATS[fmt])
+        response.vary = ("Accept",)
+        return response
+
+    @view_config(route_name="gallery", renderer="json")
+    def gallery(self):
+        """ Return the coordinate map of the matchdict specified page of
+        the newest reports contact sheet, with links to the sprite and
+        each report pdf.
+        """
+        page = self.matchdict_page()
+        manifest = page is not None and gallery_page(page)
+        if not manifest:
+            return HTTPNotFound()
+
+        # The sprite url changes whenever the page is rebuilt, so
+        # gallery_sprite can let the browser cache it for good
+        sprite_url = self.request.route_path("gallery_sprite", page=page,
+                                    _query={"v": sprite_version(manifest)})
+        tiles = []
+        for tile in manifest["tiles"]:
+            pdf_url = self.request.route_path("view_pdf",
+                                              serial=tile["serial"])
+            tiles.append({"serial": tile["serial"], "x": tile["x"],
+                          "y": tile["y"], "pdf_url": pdf_url})
+
+        return {"page": page, "pages": manifest["pages"],
+                "tile_width": manifest["tile_width"],
+                "tile_height": manifest["tile_height"],
+                "sprite_url": sprite_url, "tiles": tiles}
+
+    @view_config(route_name="gallery_sprite")
+    def gallery_sprite(self):
+        """ Return the contact sheet jpeg of the matchdict specified
+        page, rebuilding it first if it is stale. Requested with the
+        version of the current page, from the gallery sprite_url, the
+        response never expires.
+        """
+        page = self.matchdict_page()
+        manifest = page is not None and gallery_page(page)
+        if not manifest or not manifest["tiles"]:
+            return HTTPNotFound()
+
+        response = FileResponse(sprite_filename(page),
+                                content_type="image/jpeg")
+        if self.request.params.get("v") == sprite_version(manifest):
+            response.cache_control = "public, max-age=31536000, immutable"
+        return response
+
+    def matchdict_page(self):
+        """ Return the integer page number from the matchdict, None if
+        it is not a number.
+        """
+        try:
+            return int(self.request.matchdict["page"])
+        except ValueError:
+            return None
+
+    @view_config(route_name="bundle")
+    def bundle(self):
+        """ Return the matchdict specified fingerprinted asset bundle,
+        the precompressed variant if the client accepts it. The content
+        hash changes with every build so the response never expires.
+        """
+        filename = self.request.matchdict["filename"]
+        manifest = getattr(self.request.registry, "asset_manifest", {})
+        if filename not in manifest.values():
+            return HTTPNotFound()
+
+        # A server started before the last build may still list bundles
+        # that have since expired
+        full_name = "%s/dist/%s" % (ASSETS_DIR, filename)
+        if not os.path.exists(full_name):
+            return HTTPNotFound()
+
+        extension = os.path.splitext(filename)[1]
+        content_type = CONTENT_TYPES[extension]
+
+        # Highest quality precompressed variant on disk, ties go to the
+        # order of ENCODINGS
+        encoding = None
+        best = 0
+        qualities = header_qualities(self.request.headers.get(
+                                     "Accept-Encoding", ""))
+        for name, suffix in ENCODINGS:
+            quality = qualities.get(name, qualities.get("*", 0))
+            if quality > best and os.path.exists(full_name + suffix):
+                encoding, best = name, quality
+
+        if encoding is not None:
+            full_name += dict(ENCODINGS)[encoding]
+
+        response = FileResponse(full_name, request=self.request,
+                                content_type=content_type)
+        response.content_encoding = encoding
+        response.vary = ("Accept-Encoding",)
+        response.cache_control = "public, max-age=31536000, immutable"
+        return response
 
     @view_config(route_name="view_pdf")
     def view_pdf(self):
@@ -59,25 +223,108 @@ class CalibrationReportViews(object):
                 appstruct = form.validate(controls)
                 rendered_form = form.render(appstruct)
 
-                report = self.populate_data(appstruct)
-                self.makedir_write_files(appstruct)
-                pdf = WasatchSinglePage(filename=report.filename,
-                                        report=report)
-                pdf.write_thumbnail()
+                summary = self.generate_report(appstruct)
 
-                return {"form":rendered_form, "appstruct":appstruct}
+                return {"form":rendered_form, "appstruct":appstruct,
+                        "regeneration":summary}
 
             except ValidationFailure as exc: 
                 #log.exception(exc)
                 log.info("Validation failure")
                 return {'form':exc.render()} 
 
+            except ReportSizeError as exc:
+                # Even the smallest profile is over its budget, the
+                # uploads are kept for the next submission
+                log.error("Report over every size budget: %s", exc)
+                error = colander.Invalid(form.schema,
+                                         "The report is too large: %s" % exc)
+                form.widget.handle_error(form, error)
+                return {"form":form.render(appstruct)}
+
         return {"form":form.render()}
 
-    def makedir_write_files(self, appstruct):
+    def generate_report(self, appstruct):
+        """ Write the uploads, render the pdf and thumbnails for the
+        submitted form. Stages whose inputs are unchanged since the last
+        submission for the serial number are skipped: identical uploads
+        are not rewritten, an identical report is not rendered at all,
+        and when only the text changed just the form page thumbnail is
+        rasterized, the other variants are regenerated when viewed.
+        Return the summary of what ran and was skipped.
+        """
+        final_dir = "reports/%s" % slugify(appstruct["serial"])
+        regeneration = Regeneration(final_dir)
+        self.makedir_write_files(appstruct, regeneration)
+
+        report = self.populate_data(appstruct)
+        profile = self.pdf_profile()
+        image_digests = [file_digest(filename)
+                         if os.path.exists(filename) else ""
+                         for filename in [report.top_image_filename,
+                                          report.bottom_image_filename]]
+        image_inputs = fingerprint(report.layout, profile, *image_digests)
+        images_changed = regeneration.changed("images", image_inputs)
+        content_changed = regeneration.changed("content",
+            fingerprint(image_inputs, report.serial, report.coefficient_0,
+                        report.coefficient_1, report.coefficient_2,
+                        report.coefficient_3))
+
+        thumbnail = thumbnail_filename(report.filename)
+        if not content_changed and os.path.exists(report.filename) \
+           and os.path.exists(thumbnail):
+            regeneration.skip("render_pdf")
+            regeneration.skip("thumbnails")
+
+        else:
+            with regeneration.stage("render_pdf"):
+                pdf = self.render_pdf(report, profile)
+
+            # Lazily generated variants of the old report are stale
+            if images_changed or not os.path.exists(thumbnail):
+                remove_thumbnails(report.filename, DEFAULT_THUMBNAILS)
+                with regeneration.stage("thumbnails"):
+                    pdf.write_thumbnail()
+            else:
+                remove_thumbnails(report.filename, PAGE_THUMBNAILS)
+                with regeneration.stage("thumbnail_medium"):
+                    pdf.write_thumbnail(PAGE_THUMBNAILS)
+                saved = regeneration.last_timing("thumbnails") \
+                        - regeneration.timings["thumbnail_medium"]
+                regeneration.skip("thumbnail_variants", max(0.0, saved))
+
+        regeneration.save()
+        return regeneration.summary()
+
+    def render_pdf(self, report, profile):
+        """ Render the report pdf with the output profile. While the
+        report is over the size budget of the profile, render it again
+        with the next smaller one. ReportSizeError is raised if even the
+        smallest profile does not fit.
+        """
+        while True:
+            try:
+                return WasatchSinglePage(filename=report.filename,
+                                         report=report, profile=profile)
+            except ReportSizeError as exc:
+                smaller = smaller_profile(profile)
+                if smaller is None:
+                    raise
+                log.warn("%s, retrying with the %s profile", exc, smaller)
+                profile = smaller
+
+    def pdf_profile(self):
+        """ Return the output profile name from the .ini settings, None
+        for the default profile.
+        """
+        settings = self.request.registry.settings or {}
+        return settings.get("calibrationreport.pdf_profile")
+
+    def makedir_write_files(self, appstruct, regeneration=None):
         """ With parameters in the post request, create a destination
         directory in reports/ then write each of the post requests files
-        to disk.
+        to disk. With a Regeneration, uploads identical to the file
+        already on disk are not written again.
         """
  
         # Create the directory if it does not exist
@@ -86,24 +333,35 @@ class CalibrationReportViews(object):
             log.info("Make directory: %s", final_dir)
             os.makedirs(final_dir)
 
-        if appstruct["top_image_upload"] != colander.null:
-            upload = appstruct["top_image_upload"]
-            final_file = "%s/top_image.png" % final_dir
-            self.single_file_write(upload["fp"], final_file)
+        for name in ["top_image", "bottom_image"]:
+            upload = appstruct["%s_upload" % name]
+            if upload == colander.null:
+                continue
+
+            final_file = "%s/%s.png" % (final_dir, name)
+            stage = "write_%s" % name
+            if regeneration is not None:
+                changed = regeneration.changed(stage,
+                                               stream_digest(upload["fp"]))
+                if not changed and os.path.exists(final_file):
+                    regeneration.skip(stage)
+                    continue
 
-        if appstruct["bottom_image_upload"] != colander.null:
-            upload = appstruct["bottom_image_upload"]
-            final_file = "%s/bottom_image.png" % final_dir
-            self.single_file_write(upload["fp"], final_file)
+                with regeneration.stage(stage):
+                    self.single_file_write(upload["fp"], final_file)
+            else:
+                self.single_file_write(upload["fp"], final_file)
 
     def single_file_write(self, file_pointer, filename):
         """ Read from the file pointer, write intermediate file, and
-        then copy to final destination.
+        then copy to final destination. The intermediate file is unique
+        to this request and in the destination directory, so the rename
+        is atomic.
         """
-        temp_file = "reports/temp_file"
+        handle, temp_file = tempfile.mkstemp(dir=os.path.dirname(filename))
 
         file_pointer.seek(0)
-        with open(temp_file, "wb") as output_file:
+        with os.fdopen(handle, "wb") as output_file:
             shutil.copyfileobj(file_pointer, output_file)
 
         os.rename(temp_file, filename)
@@ -121,16 +379,20 @@ class CalibrationReportViews(object):
         local.coefficient_1 = appstruct["coefficient_1"]
         local.coefficient_2 = appstruct["coefficient_2"]
         local.coefficient_3 = appstruct["coefficient_3"]
+        local.layout = appstruct["layout"]
 
-        # Images are optional, set to placeholder if not specified
+        # Images are optional, set to the layout placeholder if not
+        # specified
+        placeholders = compile_layout(local.layout).placeholders
         if appstruct["top_image_upload"] == colander.null:
-            local.top_image_filename = "resources/image0_defined.jpg"
+            local.top_image_filename = placeholders["top_image_filename"]
         else:
             local.top_image_filename = "reports/%s/top_image.png" \
                                        % local.slugged
 
         if appstruct["bottom_image_upload"] == colander.null:
-            local.bottom_image_filename = "resources/image1_defined.jpg"
+            local.bottom_image_filename = \
+                placeholders["bottom_image_filename"]
         else:
             local.bottom_image_filename = "reports/%s/bottom_image.png" \
                                           % local.slugged
@@ -50,5 +50,9 @@ setup(name="calibrationreport",
       entry_points="""\
       [paste.app_factory]
       main = calibrationreport:main
+      [console_scripts]
+      calibrationreport_bundle = calibrationreport.bundle:main
+      calibrationreport_loadtest = calibrationreport.loadtest:main
+      calibrationreport_verify = calibrationreport.verify:main
       """,
       )